@@ -0,0 +1,92 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from transformer import _HAS_MODULE_COMPILE, _HAS_SDPA, SelfAttention, Transformer, _attn_bias
+
+requires_sdpa = pytest.mark.skipif(not _HAS_SDPA, reason="needs F.scaled_dot_product_attention (torch >= 2.0)")
+
+SRC = [[1, 5, 6, 4, 3, 9, 5, 2, 0], [1, 8, 7, 3, 4, 5, 6, 0, 0]]
+TRG = [[1, 7, 4, 3, 5, 9, 2], [1, 5, 6, 2, 4, 7, 6]]
+
+
+def _attention_pair(embed_size=32, heads=4):
+    torch.manual_seed(0)
+    sdpa = SelfAttention(embed_size, heads).eval()
+    bmm = SelfAttention(embed_size, heads).eval()
+    bmm.load_state_dict(sdpa.state_dict())
+    bmm.use_sdpa = False
+    return sdpa, bmm
+
+
+@requires_sdpa
+def test_bmm_matches_sdpa_padding_mask():
+    sdpa, bmm = _attention_pair()
+    x = torch.randn(2, 9, 32)
+    mask = (torch.tensor(SRC) != 0).unsqueeze(1).unsqueeze(2)
+
+    with torch.no_grad():
+        torch.testing.assert_close(bmm(x, x, x, mask), sdpa(x, x, x, mask), rtol=1e-4, atol=1e-5)
+
+
+@requires_sdpa
+def test_bmm_matches_sdpa_causal_mask():
+    sdpa, bmm = _attention_pair()
+    x = torch.randn(2, 7, 32)
+    mask = torch.ones(7, 7, dtype=torch.bool).tril().view(1, 1, 7, 7)
+
+    with torch.no_grad():
+        expected = sdpa(x, x, x, mask, is_causal=True)
+        torch.testing.assert_close(sdpa(x, x, x, mask), expected, rtol=1e-4, atol=1e-5)
+        torch.testing.assert_close(bmm(x, x, x, mask, is_causal=True), expected, rtol=1e-4, atol=1e-5)
+
+
+@requires_sdpa
+def test_float_bias_matches_bool_mask():
+    sdpa, bmm = _attention_pair()
+    x = torch.randn(2, 9, 32)
+    mask = (torch.tensor(SRC) != 0).unsqueeze(1).unsqueeze(2)
+    bias = _attn_bias(mask, torch.float32)
+
+    with torch.no_grad():
+        expected = sdpa(x, x, x, mask)
+        torch.testing.assert_close(sdpa(x, x, x, bias), expected, rtol=1e-4, atol=1e-5)
+        torch.testing.assert_close(bmm(x, x, x, bias), expected, rtol=1e-4, atol=1e-5)
+
+
+@requires_sdpa
+def test_transformer_use_sdpa_false_matches_sdpa():
+    torch.manual_seed(0)
+    model = Transformer(10, 10, 0, 0, embed_size=32, num_layers=2, heads=4, device="cpu").eval()
+    ref_model = Transformer(10, 10, 0, 0, embed_size=32, num_layers=2, heads=4, device="cpu", use_sdpa=False).eval()
+    ref_model.load_state_dict(model.state_dict())
+    src, trg = torch.tensor(SRC), torch.tensor(TRG)
+
+    # The fallback gets additive float biases, SDPA gets bool masks
+    assert ref_model.make_src_mask(src).is_floating_point()
+    assert ref_model.make_trg_mask(trg).is_floating_point()
+    assert model.make_src_mask(src).dtype == torch.bool
+
+    with torch.no_grad():
+        torch.testing.assert_close(ref_model(src, trg), model(src, trg), rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.skipif(not _HAS_MODULE_COMPILE, reason="needs nn.Module.compile (torch >= 2.2)")
+def test_compiled_forward_matches_eager():
+    torch.manual_seed(0)
+    model = Transformer(10, 10, 0, 0, embed_size=32, num_layers=2, heads=4, device="cpu").eval()
+    compiled = Transformer(10, 10, 0, 0, embed_size=32, num_layers=2, heads=4, device="cpu", compile_model=True).eval()
+    compiled.load_state_dict(model.state_dict())
+    src, trg = torch.tensor(SRC), torch.tensor(TRG)
+
+    with torch.no_grad():
+        torch.testing.assert_close(compiled(src, trg), model(src, trg), rtol=1e-4, atol=1e-4)
+
+
+def test_integer_mask_is_rejected():
+    attention = SelfAttention(32, 4).eval()
+    x = torch.randn(2, 9, 32)
+    mask = (torch.tensor(SRC) != 0).long().unsqueeze(1).unsqueeze(2)
+
+    with pytest.raises(AssertionError):
+        attention(x, x, x, mask)
@@ -1,58 +1,145 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+
+# F.scaled_dot_product_attention is only available from torch 2.0
+_HAS_SDPA = hasattr(F, "scaled_dot_product_attention")
+# In-place nn.Module.compile is only available from torch 2.2
+_HAS_MODULE_COMPILE = hasattr(nn.Module, "compile")
+
+def _attn_bias(mask: torch.tensor, dtype: torch.dtype):
+    # bool mask (True = attend) -> additive bias: 0 keep, dtype's lowest finite value drop.
+    # Finite in `dtype` only: SelfAttention clamps again when the compute dtype is narrower
+    bias = torch.zeros(mask.shape, dtype=dtype, device=mask.device)
+    return bias.masked_fill_(~mask, torch.finfo(dtype).min)
 
 class SelfAttention(nn.Module):
-    def __init__(self, embed_size: int, heads: int) -> None:
+    def __init__(self, embed_size: int, heads: int, dropout: float = 0.0) -> None:
         super().__init__()
         self.embed_size = embed_size
         self.heads = heads
         self.head_dim = embed_size // heads
+        # Optional dropout on the attention weights (off by default), applied inside the SDPA kernel
+        self.dropout_p = dropout
+        # False forces the baddbmm/bmm fallback even when SDPA is available
+        self.use_sdpa = _HAS_SDPA
 
         assert (self.head_dim * self.heads == self.embed_size), "Embed size needs to be div by heads"
 
-        self.values = nn.Linear(self.head_dim, self.head_dim, bias=False)
-        self.keys = nn.Linear(self.head_dim, self.head_dim, bias=False)
-        self.queries = nn.Linear(self.head_dim, self.head_dim, bias=False)
-        self.fc_out = nn.Linear(self.heads*self.head_dim, self.embed_size)
+        # Softmax temperature 1/sqrt(d_k), d_k being the per-head dim
+        self.scale = self.head_dim ** -0.5
 
-    def forward(self, values: torch.tensor, keys: torch.tensor, queries: torch.tensor, mask: torch.tensor):
-        N = queries.shape[0]
-        value_len, key_len, query_len = values.shape[1], keys.shape[1], queries.shape[1]
+        # Q, K, V projections stacked into one weight: [W_q; W_k; W_v]
+        self.qkv = nn.Linear(self.embed_size, 3*self.embed_size, bias=False)
+        self.fc_out = nn.Linear(self.embed_size, self.embed_size)
 
-        # Split embedding into self.heads pieces
-        values = values.reshape(N, value_len, self.heads, self.head_dim)
-        keys = keys.reshape(N, key_len, self.heads, self.head_dim)
-        queries = queries.reshape(N, query_len, self.heads, self.head_dim)
+    def forward(self, values: torch.tensor, keys: torch.tensor, queries: torch.tensor, mask: torch.tensor, is_causal: bool = False):
+        N, query_len = queries.shape[0], queries.shape[1]
 
-        values = self.values(values)
-        keys = self.keys(keys)
-        queries = self.queries(queries)
+        # Projections land as (N, heads, seq_len, head_dim) after one permute + copy each
+        if values is keys and keys is queries:
+            # Self-attention: one GEMM for all three projections
+            queries, keys, values = self._split_heads(self.qkv(queries), 3)
+        elif values is keys:
+            # Encoder-decoder attention: K and V come from the same tensor, one GEMM for both
+            w_q, w_kv = self.qkv.weight.split([self.embed_size, 2*self.embed_size], dim=0)
+            queries, = self._split_heads(F.linear(queries, w_q), 1)
+            keys, values = self._split_heads(F.linear(keys, w_kv), 2)
+        else:
+            w_q, w_k, w_v = self.qkv.weight.chunk(3, dim=0)
+            queries, = self._split_heads(F.linear(queries, w_q), 1)
+            keys, = self._split_heads(F.linear(keys, w_k), 1)
+            values, = self._split_heads(F.linear(values, w_v), 1)
 
-        energy = torch.einsum("nqhd, nkhd -> nhqk", [queries, keys])
-        # queries shape: (N, query_len, heads, heads_dim)
-        # keys shape: (N, key_len, heads, heads_dim)
-        # energy shape: (N, heads, query_len, key_len)
-
-        if mask is not None:
-            energy = energy.masked_fill(mask == 0, float("-1e20"))
- 
-        attention = torch.softmax(energy / (self.embed_size**(1/2)), dim=3)
+        # mask: bool (True means "attend") or additive float bias (SDPA convention: 0 keep, very negative drop),
+        # broadcast over (N, heads, query_len, key_len). Unlike the old `mask == 0` check, a 0/1 float mask
+        # would be read as a bias, so pass such masks as mask.bool(); integer masks are rejected
+        if mask is not None and mask.dtype != torch.bool:
+            assert mask.is_floating_point(), "mask must be bool (True = attend) or an additive float bias"
+            if mask.dtype != queries.dtype:
+                # e.g. fp32 bias under bf16 autocast: finfo(float32).min would round to -inf (NaN on fully
+                # masked rows), so clamp to the compute dtype's lowest finite value
+                mask = mask.to(queries.dtype).clamp(min=torch.finfo(queries.dtype).min)
 
-        out = torch.einsum("nhql, nlhd -> nqhd", [attention, values])
-        # attention shape: (N, heads, query_len, key_len)
-        # values shape: (N, value_len, heads, heads_dim)
-        # out shape: (N, query_len, heads, head_dim)
+        # is_causal: the caller guarantees mask is exactly the causal triangle, so SDPA may apply
+        # causality itself (flash causal path) instead of reading the mask; the fallback uses the mask
+        assert (mask is not None or not is_causal), "is_causal needs the causal mask it stands for"
+        dropout_p = self.dropout_p if self.training else 0.0
+        if self.use_sdpa:
+            # Fused QK^T / softmax / dropout / AV, SDPA's default scale is self.scale
+            out = F.scaled_dot_product_attention(
+                queries, keys, values,
+                attn_mask=None if is_causal else mask, dropout_p=dropout_p, is_causal=is_causal
+            )
+        else:
+            out = self._bmm_attention(queries, keys, values, mask, dropout_p)
+        # out shape: (N, heads, query_len, head_dim)
 
-        out = out.reshape(N, query_len, self.heads*self.head_dim)
+        # One explicit copy back to (N, query_len, embed_size)
+        out = out.transpose(1, 2).contiguous().view(N, query_len, self.embed_size)
         out = self.fc_out(out)
         return out
 
+    def _split_heads(self, x: torch.tensor, n: int):
+        # (N, seq_len, n*embed_size) -> n x (N, heads, seq_len, head_dim)
+        N, seq_len = x.shape[0], x.shape[1]
+        x = x.view(N, seq_len, n, self.heads, self.head_dim).permute(2, 0, 3, 1, 4).contiguous()
+        return x.unbind(0)
+
+    def _bmm_attention(self, queries: torch.tensor, keys: torch.tensor, values: torch.tensor, mask: torch.tensor, dropout_p: float):
+        # Eager fallback on 3D batched matmuls instead of einsum
+        N, heads, query_len, head_dim = queries.shape
+        key_len = keys.shape[2]
+
+        # (N, heads, seq_len, head_dim) -> (N*heads, seq_len, head_dim)
+        queries = queries.reshape(N*heads, query_len, head_dim)
+        keys = keys.reshape(N*heads, key_len, head_dim)
+        values = values.reshape(N*heads, key_len, head_dim)
+
+        if mask is not None:
+            # Additive bias so that baddbmm applies the mask in the same pass as QK^T.
+            # Transformer hands over a bias built once per forward; bool masks are converted here
+            bias = _attn_bias(mask, queries.dtype) if mask.dtype == torch.bool else mask
+            mask_q_len = bias.shape[2]  # query_len, or 1 for a padding mask
+            if bias.shape[0] == 1 and bias.shape[1] == 1:
+                bias = bias[0]  # (1, mask_q_len, key_len)
+            else:
+                bias = bias.expand(N, heads, mask_q_len, key_len).reshape(N*heads, mask_q_len, key_len)
+            # baddbmm broadcasts the rest up to (N*heads, query_len, key_len)
+            beta = 1
+        else:
+            # Ignored with beta=0, only has to broadcast
+            bias = queries.new_empty(1, 1, 1)
+            beta = 0
+
+        # Scaling is fused into the QK^T matmul via alpha
+        energy = torch.baddbmm(bias, queries, keys.transpose(1, 2), beta=beta, alpha=self.scale)
+        # energy shape: (N*heads, query_len, key_len)
+
+        attention = torch.softmax(energy, dim=-1)
+        if dropout_p > 0.0:
+            attention = F.dropout(attention, p=dropout_p)
+        out = torch.bmm(attention, values)
+        return out.view(N, heads, query_len, head_dim)
+
+class RMSNorm(nn.Module):
+    def __init__(self, embed_size: int, eps: float = 1e-6) -> None:
+        super().__init__()
+        self.eps = eps
+        self.weight = nn.Parameter(torch.ones(embed_size))
+
+    def forward(self, x: torch.tensor):
+        # LayerNorm without mean subtraction and bias: x / rms(x) * weight, statistics in fp32
+        x_fp32 = x.float()
+        out = x_fp32 * torch.rsqrt(x_fp32.pow(2).mean(-1, keepdim=True) + self.eps)
+        return out.type_as(x) * self.weight
+
 class TransformerBlock(nn.Module):
-    def __init__(self, embed_size: int, heads: int, dropout: float, forward_expansion: int) -> None:
+    def __init__(self, embed_size: int, heads: int, dropout: float, forward_expansion: int, rms_norm: bool = False, attn_dropout: float = 0.0) -> None:
         super().__init__()
-        self.attention = SelfAttention(embed_size=embed_size, heads=heads)
-        self.norm1 = nn.LayerNorm(embed_size)
-        self.norm2 = nn.LayerNorm(embed_size)
+        self.attention = SelfAttention(embed_size=embed_size, heads=heads, dropout=attn_dropout)
+        self.norm1 = RMSNorm(embed_size) if rms_norm else nn.LayerNorm(embed_size)
+        self.norm2 = RMSNorm(embed_size) if rms_norm else nn.LayerNorm(embed_size)
 
         self.feed_forward = nn.Sequential(
                                         nn.Linear(embed_size, forward_expansion*embed_size),
@@ -61,12 +148,15 @@ class TransformerBlock(nn.Module):
                                         )
         self.dropout = nn.Dropout(p=dropout)
 
-    def forward(self, values: torch.tensor, keys: torch.tensor, queries: torch.tensor, mask: bool):
+    def forward(self, values: torch.tensor, keys: torch.tensor, queries: torch.tensor, mask: torch.tensor):
         attention = self.attention(values, keys, queries, mask)
         
         x = self.dropout(self.norm1(attention + queries))
         forward = self.feed_forward(x)
-        out = self.dropout(self.norm2(forward + x))
+        # forward is a fresh Linear output nobody else holds, so the residual can be added in place,
+        # unless autocast made it bf16 while x (LayerNorm output) is fp32: then keep the sum in fp32
+        residual = forward.add_(x) if forward.dtype == x.dtype else forward + x
+        out = self.dropout(self.norm2(residual))
         return out 
 
 class Encoder(nn.Module):
@@ -78,25 +168,28 @@ class Encoder(nn.Module):
                 device,
                 forward_expansion: int,
                 dropout: float,
-                max_length: int           # about position embedding
+                max_length: int,          # about position embedding
+                rms_norm: bool = False,
+                attn_dropout: float = 0.0
                 ) -> None:
         super().__init__()
         self.embed_size = embed_size
         self.device = device
         self.word_embedding = nn.Embedding(src_vocab_size, embed_size)
         self.position_embedding = nn.Embedding(max_length, embed_size)
+        self.register_buffer("positions", torch.arange(0, max_length).unsqueeze(0), persistent=False)
 
         self.layers = nn.ModuleList(
             [
-                TransformerBlock(embed_size=embed_size, heads=heads, dropout=dropout, forward_expansion=forward_expansion)
+                TransformerBlock(embed_size=embed_size, heads=heads, dropout=dropout, forward_expansion=forward_expansion, rms_norm=rms_norm, attn_dropout=attn_dropout)
                 for _ in range(num_layers)
             ]
         )
         self.dropout = nn.Dropout(dropout)
 
     def forward(self, x: torch.tensor, mask: torch.tensor):
-        N, seq_length = x.shape
-        positions = torch.arange(0, seq_length).expand(N, seq_length).to(self.device)
+        seq_length = x.shape[1]
+        positions = self.positions[:, :seq_length]
         
         out = self.dropout(self.word_embedding(x) + self.position_embedding(positions))
 
@@ -105,15 +198,16 @@ class Encoder(nn.Module):
         return out
 
 class DecoderBLock(nn.Module):
-    def __init__(self, embed_size: int, heads: int, forward_expansion: int, dropout: float, device) -> None:
+    def __init__(self, embed_size: int, heads: int, forward_expansion: int, dropout: float, device, rms_norm: bool = False, attn_dropout: float = 0.0) -> None:
         super().__init__()
-        self.attention = SelfAttention(embed_size, heads)
-        self.norm = nn. LayerNorm(embed_size)
-        self.transformer_block = TransformerBlock(embed_size, heads, dropout, forward_expansion)
+        self.attention = SelfAttention(embed_size, heads, attn_dropout)
+        self.norm = RMSNorm(embed_size) if rms_norm else nn.LayerNorm(embed_size)
+        self.transformer_block = TransformerBlock(embed_size, heads, dropout, forward_expansion, rms_norm, attn_dropout)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, x, values, keys, src_mask, trg_mask):
-        attention = self.attention(x, x, x, trg_mask)
+    def forward(self, x, values, keys, src_mask, trg_mask, causal: bool = False):
+        # causal: trg_mask is exactly the causal triangle (see SelfAttention.forward)
+        attention = self.attention(x, x, x, trg_mask, is_causal=causal)
         queries = self.dropout(self.norm(attention + x))
         out = self.transformer_block(values, keys, queries, src_mask)
         return out
@@ -127,28 +221,31 @@ class Decoder(nn.Module):
                 forward_expansion: int,
                 dropout: float,
                 device,
-                max_length: int
+                max_length: int,
+                rms_norm: bool = False,
+                attn_dropout: float = 0.0
                 ) -> None:
         super().__init__()
         self.device= device
         self.word_embedding = nn.Embedding(trg_vocab_size, embed_size)
         self.position_embedding = nn.Embedding(max_length, embed_size)
+        self.register_buffer("positions", torch.arange(0, max_length).unsqueeze(0), persistent=False)
         self.layers = nn.ModuleList(
             [
-                DecoderBLock(embed_size=embed_size, heads=heads, forward_expansion=forward_expansion, dropout=dropout, device=device)
+                DecoderBLock(embed_size=embed_size, heads=heads, forward_expansion=forward_expansion, dropout=dropout, device=device, rms_norm=rms_norm, attn_dropout=attn_dropout)
                 for _ in range(num_layers)
             ]
         )
         self.fc_out = nn.Linear(embed_size, trg_vocab_size)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, x, enc_out, src_mask, trg_mask):
-        N, seq_length = x.shape
-        positions = torch.arange(0, seq_length).expand(N, seq_length).to(self.device)
+    def forward(self, x, enc_out, src_mask, trg_mask, causal: bool = False):
+        seq_length = x.shape[1]
+        positions = self.positions[:, :seq_length]
         x = self.dropout((self.word_embedding(x) + self.position_embedding(positions)))
 
         for layer in self.layers:
-            x = layer(x, enc_out, enc_out, src_mask, trg_mask)
+            x = layer(x, enc_out, enc_out, src_mask, trg_mask, causal)
         
         out = self.fc_out(x)
         return out
@@ -165,8 +262,14 @@ class Transformer(nn.Module):
                 heads: int = 8,
                 dropout: float = 0,
                 device = "cuda",
-                max_length: int = 100) -> None:
+                max_length: int = 100,
+                compile_model: bool = False,
+                rms_norm: bool = False,
+                use_sdpa: bool = _HAS_SDPA,
+                attn_dropout: float = 0.0) -> None:
         super().__init__()
+        assert (_HAS_SDPA or not use_sdpa), "scaled_dot_product_attention needs torch >= 2.0"
+        assert (_HAS_MODULE_COMPILE or not compile_model), "compile_model needs torch >= 2.2"
 
         self.encoder = Encoder(
                                 src_vocab_size,
@@ -176,7 +279,9 @@ class Transformer(nn.Module):
                                 device,
                                 forward_expansion,
                                 dropout,
-                                max_length
+                                max_length,
+                                rms_norm,
+                                attn_dropout
                                 )
         self.decoder = Decoder(
                                 trg_vocab_size,
@@ -186,37 +291,64 @@ class Transformer(nn.Module):
                                 forward_expansion,
                                 dropout,
                                 device,
-                                max_length
+                                max_length,
+                                rms_norm,
+                                attn_dropout
                                 )
         self.src_pad_idx = src_pad_idx
         self.trg_pad_idx = trg_pad_idx
         self.device= device
+        self.use_sdpa = use_sdpa
+        for module in self.modules():
+            if isinstance(module, SelfAttention):
+                module.use_sdpa = use_sdpa
+        # Lower-triangular bool mask (query i attends to key j <= i), built without a float ones tensor
+        idx = torch.arange(max_length)
+        self.register_buffer(
+            "causal_mask",
+            (idx[:, None] >= idx[None, :]).view(1, 1, max_length, max_length),
+            persistent=False
+        )
+        # Same mask as an additive bias for the bmm fallback; a float buffer, so it follows the model's dtype
+        self.register_buffer("causal_bias", _attn_bias(self.causal_mask, torch.get_default_dtype()), persistent=False)
+
+        if compile_model:
+            # In-place Module.compile keeps state_dict keys free of the "_orig_mod." prefix;
+            # dynamic shapes avoid a recompile per sequence length
+            self.encoder.compile(mode="max-autotune", dynamic=True)
+            self.decoder.compile(mode="max-autotune", dynamic=True)
 
     def make_src_mask(self, src):
+        # bool, already on src's device: (N, 1, 1, src_len)
         src_mask = (src != self.src_pad_idx).unsqueeze(1).unsqueeze(2)
-        # (N, 1, 1, src_len)
-        return src_mask.to(self.device)
+        if self.use_sdpa:
+            return src_mask
+        # bmm fallback: additive bias built once here instead of in every layer
+        return _attn_bias(src_mask, self.encoder.word_embedding.weight.dtype)
 
     def make_trg_mask(self, trg):
-        N, trg_len = trg.shape
-        trg_mask = torch.tril(torch.ones((trg_len, trg_len))).expand(N, 1, trg_len, trg_len)
-        return trg_mask.to(self.device)
+        trg_len = trg.shape[1]
+        if self.use_sdpa:
+            # bool, broadcast over the batch: (1, 1, trg_len, trg_len)
+            return self.causal_mask[:, :, :trg_len, :trg_len]
+        # bmm fallback: additive bias, broadcast over the batch: (1, 1, trg_len, trg_len)
+        return self.causal_bias[:, :, :trg_len, :trg_len]
 
     def forward(self, src, trg):
         src_mask = self.make_src_mask(src)
         trg_mask = self.make_trg_mask(trg)
         enc_src = self.encoder(src, src_mask)
-        out = self.decoder(trg, enc_src, src_mask, trg_mask)
+        # trg_mask is the cached causal slice, so SDPA can take its is_causal path
+        out = self.decoder(trg, enc_src, src_mask, trg_mask, causal=True)
         return out
 
 if __name__ == "__main__":
-    device = torch.device("mps")
+    device = torch.device("mps" if torch.backends.mps.is_available() else "cpu")
     print(device)
 
-    x = torch.tensor([[1, 5, 6, 4, 3, 9, 5, 2, 0], [1, 8, 7, 3, 4, 5, 6, 7, 2]]).to(
-        device
-    )
-    trg = torch.tensor([[1, 7, 4, 3, 5, 9, 2, 0], [1, 5, 6, 2, 4, 7, 6, 2]]).to(device)
+    # Created directly on the device, masks built from them stay there too
+    x = torch.tensor([[1, 5, 6, 4, 3, 9, 5, 2, 0], [1, 8, 7, 3, 4, 5, 6, 7, 2]], device=device)
+    trg = torch.tensor([[1, 7, 4, 3, 5, 9, 2, 0], [1, 5, 6, 2, 4, 7, 6, 2]], device=device)
 
     src_pad_idx = 0
     trg_pad_idx = 0
@@ -225,5 +357,8 @@ if __name__ == "__main__":
     model = Transformer(src_vocab_size, trg_vocab_size, src_pad_idx, trg_pad_idx, device=device).to(
         device
     )
-    out = model(x, trg[:, :-1])
-    print(out.shape)
\ No newline at end of file
+    # bf16 matmuls and SDPA (flash SDPA needs fp16/bf16), LayerNorm stays fp32.
+    # SDPA's softmax runs inside the kernel on the bf16 Q/K/V, not as a separate fp32 op
+    with torch.autocast(device_type=device.type, dtype=torch.bfloat16):
+        out = model(x, trg[:, :-1])
+    print(out.shape)